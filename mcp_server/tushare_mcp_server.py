@@ -11,11 +11,20 @@
 5.定义工具函数（四个工具）
 6.启动服务器
 """
-import tushare as ts
 from mcp.server.fastmcp import FastMCP
+import asyncio
+import hashlib
+import itertools
 import sys
-import json
 import os
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 #加载环境变量，读取.env
@@ -24,13 +33,123 @@ load_dotenv()
 #1.创建MCP服务器，名为StockServer
 mcp = FastMCP("StockServer")
 
-#2.设置Tushare API，用token创建一个TushareAPI连接，把它赋值给api变量
-token = os.getenv('TUSHARE_TOKEN')
-api = ts.pro_api(token)
+#2.设置Tushare API，用token创建TushareAPI连接，通过get_api()获取
+#TUSHARE_TOKENS可以配置多个token（逗号分隔），轮流使用以提高每分钟调用次数上限；没有配置时使用TUSHARE_TOKEN
+tokens = [t.strip() for t in os.getenv('TUSHARE_TOKENS', '').split(',') if t.strip()] or [os.getenv('TUSHARE_TOKEN')]
+#超时分开设置：连接10秒（连不上尽快失败重试），读取60秒（大表查询需要时间）
+TUSHARE_TIMEOUT = (10, 60)
+
+#Tushare SDK每次查询都直接调用requests.post，每次都要重新建立TCP连接
+#这里换成带连接池的共享Session，所有工具函数复用keep-alive连接，连接失败时自动重试
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                           max_retries=Retry(total=3, backoff_factor=0.3))
+http_session.mount('http://', http_adapter)
+http_session.mount('https://', http_adapter)
+
+#tushare会连带导入pandas、numpy等重量级模块，推迟到第一次调用工具时再导入，MCP服务器启动更快
+apis = None
+
+def get_api():
+    """轮询取出下一个Tushare API连接，所有连接共用上面的HTTP连接池"""
+    global apis
+    if apis is None:
+        import tushare as ts
+        from tushare.pro import client as ts_client
+        ts_client.requests = http_session
+        apis = itertools.cycle([ts.pro_api(token, timeout=TUSHARE_TIMEOUT) for token in tokens])
+    return next(apis)
+
+#固定不变的配置在模块加载时准备好，不用每次调用工具都重新构建
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+#价格数据只返回关键字段
+PRICE_COLUMNS = ['trade_date', 'open', 'high', 'low', 'close', 'pct_chg']
+PRICE_FIELDS = ','.join(PRICE_COLUMNS)
+
+def to_json(result):
+    """把DataFrame转成紧凑的JSON字符串（按行记录），orjson比to_json/json.dumps快得多，且原生支持numpy类型
+    整列都是空值的字段直接去掉（财务指标表有上百列，很多为空），减少发给大模型的token
+    """
+    result = result.dropna(axis=1, how='all')
+    #逐列tolist()在C里把整列转成Python对象，再zip成按行记录，避免to_dict(orient='records')逐行逐个值地转换
+    columns = list(result.columns)
+    records = [dict(zip(columns, row)) for row in zip(*(result[column].tolist() for column in columns))]
+    return orjson.dumps(records, option=JSON_OPTIONS).decode()
+
+#缓存有效期（秒）：基本信息和财务指标很少变化，日线数据每天更新，实时报价只缓存很短时间
+DAY = 24 * 60 * 60
+BASIC_TTL = 90 * DAY
+FINANCIAL_TTL = 90 * DAY
+PRICE_TTL = DAY
+REALTIME_TTL = 60
+
+class FileCache:
+    """
+    Tushare查询结果的两级缓存：进程内LRU字典 + 磁盘JSON文件
+    磁盘路径：.cache/{工具名}/{参数的md5}.json，服务器重启后依然有效
+    命中缓存时直接返回JSON字符串，不再请求Tushare，节省网络延迟和接口额度
+    """
+    def __init__(self, cache_dir, maxsize=128):
+        self.cache_dir = Path(cache_dir)
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+
+    def _path(self, tool_name, args):
+        key = hashlib.md5(orjson.dumps(args)).hexdigest()
+        return self.cache_dir / tool_name / f"{key}.json"
+
+    def get(self, tool_name, args, ttl):
+        """读取缓存，过期或不存在返回None"""
+        now = time.time()
+        entry = self.memory.get((tool_name, args))
+        if entry is not None and now - entry[0] < ttl:
+            self.memory.move_to_end((tool_name, args))
+            return entry[1]
+        path = self._path(tool_name, args)
+        try:
+            saved_at = path.stat().st_mtime
+            if now - saved_at >= ttl:
+                return None
+            data = path.read_text(encoding='utf-8')
+        except OSError:
+            return None
+        self._remember(tool_name, args, saved_at, data)
+        return data
+
+    def set(self, tool_name, args, data):
+        """写入缓存，先写临时文件再替换，避免并发读到写了一半的文件
+        多个智能体进程各自启动MCP服务器、共用同一个缓存目录，所以临时文件名每次都不一样，互不覆盖
+        """
+        self._remember(tool_name, args, time.time(), data)
+        path = self._path(tool_name, args)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=path.parent,
+                                             suffix='.tmp', delete=False) as tmp_file:
+                tmp_file.write(data)
+            try:
+                os.replace(tmp_file.name, path)
+            except OSError:
+                os.unlink(tmp_file.name)
+                raise
+        except OSError as e:
+            print(f"缓存写入失败: {e}", file=sys.stderr)
+
+    def _remember(self, tool_name, args, saved_at, data):
+        self.memory[(tool_name, args)] = (saved_at, data)
+        self.memory.move_to_end((tool_name, args))
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+#缓存目录放在项目根目录下，不受启动目录影响
+cache = FileCache(Path(__file__).resolve().parent.parent / '.cache')
+
+#工具函数都定义成async，阻塞的Tushare请求放到线程池里执行
+#这样大模型一次返回多个工具调用时（ToolNode会并发执行），服务器端可以同时处理，而不是排队一个个等网络返回
 
 #3.定义一个工具函数:获取股票基本信息
 @mcp.tool()
-def get_stock_basic(stock_code):
+async def get_stock_basic(stock_code):
     """
     获取股票基本信息
     Args:stock_code:股票代码，000001.SZ,值传递给ts_code
@@ -40,55 +159,78 @@ def get_stock_basic(stock_code):
     ts_code:API 函数定义的参数名
     str(e)：把异常对象e转换成字符串
     """
+    cached = cache.get('stock_basic', (stock_code,), BASIC_TTL)
+    if cached is not None:
+        return cached
     try:
-        result = api.stock_basic(ts_code=stock_code)
-        return result.to_json(orient='records', force_ascii=False)
+        result = await asyncio.to_thread(get_api().stock_basic, ts_code=stock_code)
+        data = to_json(result)
+        #空结果（比如代码写错）不缓存
+        if not result.empty:
+            cache.set('stock_basic', (stock_code,), data)
+        return data
     except Exception as e:
-        return json.dumps({'error': str(e)})
+        return orjson.dumps({'error': str(e)}).decode()
 
 #4.添加第二个工具函数:获取股票价格
 @mcp.tool()
-def get_stock_price(stock_code, limit=3):
+async def get_stock_price(stock_code, limit=3):
    """
    获取股票最近的价格数据
    调用api.daily获取每日价格数据
    limit:限制返回天数，默认只返回3天
    错误返回直接是字符串而不是JSON
    """
+   cached = cache.get('stock_price', (stock_code, limit), PRICE_TTL)
+   if cached is not None:
+       return cached
    try:
-       result = api.daily(ts_code=stock_code)
-       limited_result = result.head(limit)
-       #只选择关键字段
-       key_columns = ['trade_date', 'open', 'high', 'low', 'close', 'pct_chg']
-       simplified_result = limited_result[key_columns]
-       return simplified_result.to_json(orient='records', force_ascii=False)
+       #只请求最近limit天的关键字段，不再拉取全部历史日线再截取，传输和解析的数据量都小得多
+       result = await asyncio.to_thread(get_api().daily, ts_code=stock_code, limit=limit, fields=PRICE_FIELDS)
+       simplified_result = result[PRICE_COLUMNS]
+       data = to_json(simplified_result)
+       if not simplified_result.empty:
+           cache.set('stock_price', (stock_code, limit), data)
+       return data
    except Exception as e:
        return f"错误；{str(e)}"
 
 #5.第三个工具函数：获取股票实时报价（需要相应权限）
 @mcp.tool()
-def get_realtime_price(stock_code):
+async def get_realtime_price(stock_code):
     """获取股票实时报价"""
+    cached = cache.get('realtime_price', (stock_code,), REALTIME_TTL)
+    if cached is not None:
+        return cached
     try:
         # 使用日线数据的最新记录作为实时报价
-        result = api.daily(ts_code=stock_code, limit=1)
-        return result.to_json(orient='records', force_ascii=False)
+        result = await asyncio.to_thread(get_api().daily, ts_code=stock_code, limit=1)
+        data = to_json(result)
+        if not result.empty:
+            cache.set('realtime_price', (stock_code,), data)
+        return data
     except Exception as e:
-        return json.dumps({'error': str(e)})
+        return orjson.dumps({'error': str(e)}).decode()
 
 #6.第四个工具函数：获取财务指标数据
 @mcp.tool()
-def get_financial_indicator(stock_code, period='20231231'):
+async def get_financial_indicator(stock_code, period='20231231'):
     """
     获取财务指标数据
     Args:stock_code,period
     period='20231231' = 默认参数，如果不传period，就用'20231231'
     """
+    cached = cache.get('financial_indicator', (stock_code, period), FINANCIAL_TTL)
+    if cached is not None:
+        return cached
     try:
-        result = api.fina_indicator(ts_code=stock_code, period=period)
-        return result.to_json(orient='records', force_ascii=False)
+        result = await asyncio.to_thread(get_api().fina_indicator, ts_code=stock_code, period=period)
+        data = to_json(result)
+        if not result.empty:
+            cache.set('financial_indicator', (stock_code, period), data)
+        return data
     except Exception as e:
-        return json.dumps({'error': str(e)})
+        return orjson.dumps({'error': str(e)}).decode()
 
 #7.启动服务器
 if __name__ == "__main__":
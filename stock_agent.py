@@ -7,15 +7,22 @@ LangGraph是什么？
 用户问题--LangGraph工作流--MCP工具--数据--回答
 """
 import asyncio
+import functools
+import json
 import os
+import re
+import sys
+from contextlib import AsyncExitStack
 from typing import Annotated
+from uuid import uuid4
 
 from dotenv import load_dotenv
-from langchain_deepseek import ChatDeepSeek
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode
 from langgraph.checkpoint.memory import InMemorySaver
 from typing_extensions import TypedDict
 
@@ -29,9 +36,220 @@ class AgentState(TypedDict):
     messages: Annotated[list, add_messages]
 
 
+# 系统提示词 -- 内容固定，模块加载时创建一次，每次调用大模型都放在消息最前面
+# 前缀每轮都完全相同，DeepSeek/OpenAI的前缀缓存可以直接复用，降低首token延迟和费用
+SYSTEM_MESSAGE = SystemMessage(content=(
+    "你是A股股票查询助手。根据用户的问题调用工具获取Tushare数据，"
+    "股票代码使用Tushare格式，例如600519.SH、000001.SZ。"
+    "请将数据整理成简洁易懂的中文回答，不要编造数据。"
+))
+
+
+# 规则路由 -- 常见问题不必让大模型决定调用哪个工具，用预编译的正则直接匹配，省掉一次大模型往返
+# 常见股票名称到代码的映射
+STOCK_NAMES = {
+    "贵州茅台": "600519.SH",
+    "茅台": "600519.SH",
+    "平安银行": "000001.SZ",
+    "招商银行": "600036.SH",
+    "招行": "600036.SH",
+    "万科A": "000002.SZ",
+    "万科": "000002.SZ",
+}
+
+# 工具关键词，按优先级排列
+TOOL_KEYWORDS = {
+    "get_financial_indicator": ["财务", "指标", "业绩", "盈利", "收益"],
+    "get_realtime_price": ["实时", "当前", "现在", "最新"],
+    "get_stock_price": ["价格", "股价", "走势", "K线", "行情"],
+    "get_stock_basic": ["基本信息", "基本资料", "简介", "所属行业", "上市"],
+}
+
+# 股票名称（长的排在前面，保证"贵州茅台"优先于"茅台"匹配）和股票代码的正则片段
+# 只认A股代码段（沪市60/68、深市00/30、北交所4/8开头），后面紧跟元/股/手的是金额或数量，不是代码
+STOCK_NAME_REGEX = "|".join(map(re.escape, sorted(STOCK_NAMES, key=len, reverse=True)))
+STOCK_CODE_REGEX = r"(?<!\d)(?:60|68|00|30|4\d|8\d)\d{4}(?:\.(?:SH|SZ|BJ))?(?![\d元股手])"
+
+# 规则路由最多查询的价格天数（约一年的交易日），更多的数据放进提示词太长，交给大模型决定怎么查
+MAX_PRICE_DAYS = 250
+
+# 模块导入时把股票名称、股票代码、时间参数和所有工具关键词编译成一个带命名分组的正则
+# 一次finditer扫描就能识别出全部股票、参数和意图，分组名就是匹配到的类别（stock_name/stock_code/days/year/工具名）
+ROUTE_PATTERN = re.compile("|".join([
+    # "10天"、"20个交易日" -> get_stock_price的limit；"2022年" -> get_financial_indicator的period
+    r"(?P<days>(?<!\d)[1-9]\d{0,2}\s*个?(?:交易日|天|日))",
+    r"(?P<year>(?<!\d)(?:19|20)\d{2}\s*年)",
+    f"(?P<stock_name>{STOCK_NAME_REGEX})",
+    f"(?P<stock_code>{STOCK_CODE_REGEX})",
+    *(
+        f"(?P<{tool_name}>" + "|".join(map(re.escape, keywords)) + ")"
+        for tool_name, keywords in TOOL_KEYWORDS.items()
+    ),
+    # 其他时间说法（今天、本月、三季度等）规则无法换算成参数
+    "(?P<other_time>季度|季报|半年|年|月|周|天|日)",
+]), re.IGNORECASE)
+
+
+def normalize_stock_code(code, exchange=None):
+    """把6位代码补全成Tushare格式，比如600519 -> 600519.SH"""
+    if exchange:
+        return f"{code}.{exchange.upper()}"
+    if code[0] == "6":
+        return f"{code}.SH"
+    if code[0] in "48":
+        return f"{code}.BJ"
+    return f"{code}.SZ"
+
+
+def route_query(question):
+    """规则路由：从问题中识别股票和意图
+    参数：question--用户问题
+    返回：工具调用列表；识别不出股票或意图时返回空列表，交给大模型处理
+    """
+    stock_codes = {}
+    matched_tools = set()
+    days = []
+    years = []
+    # 没被任何分组匹配的部分
+    leftover = []
+    position = 0
+    for match in ROUTE_PATTERN.finditer(question):
+        leftover.append(question[position:match.start()])
+        position = match.end()
+        group, text = match.lastgroup, match.group()
+        if group == "stock_name":
+            stock_codes[STOCK_NAMES[text.upper()]] = None
+        elif group == "stock_code":
+            code, _, exchange = text.partition(".")
+            stock_codes[normalize_stock_code(code, exchange)] = None
+        elif group == "days":
+            days.append(int(re.match(r"\d+", text).group()))
+        elif group == "year":
+            years.append(text[:4])
+        elif group == "other_time":
+            return []
+        else:
+            matched_tools.add(group)
+
+    leftover.append(question[position:])
+    # 还剩下认不出来的数字（金额、不合法的代码等），规则无法确定含义，交给大模型
+    if re.search(r"\d", "".join(leftover)):
+        return []
+
+    # 按TOOL_KEYWORDS中的优先级排列
+    tool_names = [name for name in TOOL_KEYWORDS if name in matched_tools]
+    # 同一个参数出现多次，规则无法确定用哪个
+    if len(days) > 1 or len(years) > 1:
+        return []
+    # 0天这类写法正则不会匹配，会作为剩余数字交给大模型；天数太多同样交给大模型
+    if days and days[0] > MAX_PRICE_DAYS:
+        return []
+    # "最新"、"当前"、"现在"只是修饰词：修饰价格或者单独出现时才表示查行情，
+    # 修饰财务指标等其他意图时（"最新财务指标"）不额外查实时报价
+    if "get_realtime_price" in matched_tools:
+        matched_tools.discard("get_realtime_price")
+        if "get_stock_price" in matched_tools or not matched_tools:
+            # 指定了天数就查历史价格（"最新10天股价"），否则只需要实时报价
+            matched_tools.discard("get_stock_price")
+            matched_tools.add("get_stock_price" if days else "get_realtime_price")
+        tool_names = [name for name in TOOL_KEYWORDS if name in matched_tools]
+    # 天数只用于历史价格，年份只用于财务指标，对应不上的交给大模型
+    if days and "get_stock_price" not in tool_names:
+        return []
+    if years and "get_financial_indicator" not in tool_names:
+        return []
+
+    if not stock_codes or not tool_names:
+        return []
+
+    tool_calls = []
+    for stock_code in stock_codes:
+        for tool_name in tool_names:
+            args = {"stock_code": stock_code}
+            if tool_name == "get_stock_price" and days:
+                args["limit"] = days[0]
+            if tool_name == "get_financial_indicator" and years:
+                args["period"] = f"{years[0]}1231"
+            tool_calls.append({"name": tool_name, "args": args, "id": f"call_{uuid4().hex}", "type": "tool_call"})
+    return tool_calls
+
+
+# 模板回答 -- 结构固定的查询结果直接套模板生成回答，省掉最后一次大模型整理结果的往返
+ANSWER_TEMPLATES = {
+    "get_stock_basic": "{name}（{ts_code}）位于{area}，属于{industry}行业，{list_date}上市。",
+    "get_realtime_price": "{stock_code}最新交易日{trade_date}：开盘{open}，最高{high}，最低{low}，收盘{close}，涨跌幅{pct_chg}%。",
+    "get_stock_price": "{stock_code} {trade_date}：开盘{open}，最高{high}，最低{low}，收盘{close}，涨跌幅{pct_chg}%。",
+}
+
+# 只有"一只股票+查询意图"的纯查询才套模板，比如"茅台的股价"、"600519.SH最新行情？"
+# 问题里还有别的内容（为什么跌、值不值得买、比较多只股票、指定天数等）都要交给大模型结合问题回答
+SIMPLE_LOOKUP_PATTERN = re.compile(
+    rf"^(?:查询|查一下|看看)?\s*(?:{STOCK_NAME_REGEX}|{STOCK_CODE_REGEX})\s*的?\s*"
+    r"(?:(?:最新|实时|当前|现在)的?)?(?:基本信息|基本资料|简介|股价|价格|行情)\s*[？?。]?$",
+    re.IGNORECASE
+)
+
+# 规则路由生成的AI消息id前缀，用来区分是规则路由还是大模型发起的工具调用
+ROUTER_MESSAGE_PREFIX = "router-"
+
+
+def tool_result_text(content):
+    """取出工具结果的文本
+    新版langchain-mcp-adapters的ToolMessage.content是内容块列表（[{"type": "text", "text": ...}]），旧版直接是字符串
+    """
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block["text"] for block in content
+        if isinstance(block, dict) and block.get("type") == "text"
+    )
+
+
+def render_template_answer(messages):
+    """用模板把最近一轮规则路由的工具结果转成回答
+    参数：messages--消息历史，最后若干条是工具结果
+    返回：回答文本；不是规则路由发起的纯查询，或者有结果无法套用模板时返回None，交给大模型处理
+    """
+    tool_messages = []
+    for message in reversed(messages):
+        if not isinstance(message, ToolMessage):
+            break
+        tool_messages.insert(0, message)
+    if not tool_messages or len(tool_messages) + 2 > len(messages):
+        return None
+
+    ai_message = messages[-len(tool_messages) - 1]
+    if not (ai_message.id or "").startswith(ROUTER_MESSAGE_PREFIX):
+        return None
+    # 用户问题必须是纯查询，否则模板回答不了问题本身
+    question = messages[-len(tool_messages) - 2]
+    if not (isinstance(question, HumanMessage) and isinstance(question.content, str)
+            and SIMPLE_LOOKUP_PATTERN.match(question.content.strip())):
+        return None
+
+    stock_codes = {tool_call["id"]: tool_call["args"]["stock_code"] for tool_call in ai_message.tool_calls}
+    answers = []
+    for message in tool_messages:
+        template = ANSWER_TEMPLATES.get(message.name)
+        if template is None:
+            return None
+        try:
+            records = json.loads(tool_result_text(message.content))
+            # 查询出错或者没有数据，让大模型解释
+            if not isinstance(records, list) or not records:
+                return None
+            stock_code = stock_codes[message.tool_call_id]
+            answers += [template.format(stock_code=stock_code, **record) for record in records]
+        except (ValueError, TypeError, KeyError):
+            return None
+    return "\n".join(answers)
+
+
 # 初始化MCP工具
-async def setup_mcp_tools():
-    """设置MCP工具"""
+async def setup_mcp_tools(stack):
+    """设置MCP工具
+    参数：stack--AsyncExitStack，程序退出时负责关闭MCP会话
+    """
     try:
         #创建MCP客户端，连接本地运行的MCP服务器
         client = MultiServerMCPClient({
@@ -41,34 +259,151 @@ async def setup_mcp_tools():
                 "transport": "stdio",
             }
         })
+        #保持一个长期会话，MCP服务器子进程只启动一次，所有工具调用复用它（包括服务器里的缓存和HTTP连接池）
+        #client.get_tools()返回的工具每次调用都会新建会话、重新启动服务器子进程
+        session = await stack.enter_async_context(client.session("tushare_mcp_server"))
         #获取工具列表
-        return await client.get_tools()
+        return await load_mcp_tools(session)
     except Exception as e:
         print(f"工具初始化失败: {e}")
         return None
 
 
+# 大模型客户端单例 -- 整个进程共用一个客户端和连接池，所有轮次复用TCP/TLS连接
+@functools.cache
+def get_llm():
+    """获取大模型客户端（首次调用时创建）
+    langchain_deepseek会连带导入openai、tiktoken等模块，放到这里导入，缩短启动到第一次提示输入的时间
+    """
+    import httpx
+    from langchain_deepseek import ChatDeepSeek
+
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+    )
+    return ChatDeepSeek(model="deepseek-chat", api_key=DEEPSEEK_API_KEY, http_async_client=http_client)
+
+
 # 创建智能体 构建完整的LangGraph工作流
 def create_stock_agent(tools):
     """创建股票查询智能体
     参数：tools--从MCP服务器获取的工具列表
     返回：编译后的智能体图
     """
-    # 初始化大模型
-    llm = ChatDeepSeek(model="deepseek-chat", api_key=DEEPSEEK_API_KEY)
-    llm_with_tools = llm.bind_tools(tools)
+    # 绑定工具的大模型客户端，第一次需要大模型时才创建，规则路由能处理的问题不会触发导入
+    @functools.cache
+    def get_llm_with_tools():
+        return get_llm().bind_tools(tools)
+
+    tools_by_name = {tool.name: tool for tool in tools}
+    # 流式解码时已经提前开始执行的工具调用，键为tool_call的id，值为asyncio.Task
+    pending_calls = {}
+
+    async def run_tool_call(tool_call):
+        """执行单个工具调用，出错时返回错误信息给大模型，而不是中断工作流"""
+        tool = tools_by_name.get(tool_call["name"])
+        if tool is None:
+            return ToolMessage(content=f"Error: 未知工具 {tool_call['name']}", name=tool_call["name"],
+                               tool_call_id=tool_call["id"], status="error")
+        try:
+            return await tool.ainvoke({**tool_call, "type": "tool_call"})
+        except Exception as e:
+            return ToolMessage(content=f"Error: {e}", name=tool_call["name"],
+                               tool_call_id=tool_call["id"], status="error")
+
+    def start_tool_call(tool_call_chunk):
+        """某个工具调用的参数解码完成后立刻开始执行，不等大模型生成完整条消息
+        返回：已启动调用的id；没有启动时返回None
+        """
+        if not tool_call_chunk.get("id") or not tool_call_chunk.get("name"):
+            return None
+        try:
+            args = json.loads(tool_call_chunk["args"] or "{}")
+        except json.JSONDecodeError:
+            # 参数不合法，留给工具节点按正常流程处理
+            return None
+        tool_call = {"name": tool_call_chunk["name"], "args": args, "id": tool_call_chunk["id"]}
+        pending_calls[tool_call["id"]] = asyncio.create_task(run_tool_call(tool_call))
+        return tool_call["id"]
+
+    def cancel_tool_calls(tool_call_ids):
+        """取消已经提前启动、但不会被工具节点取走的调用，避免任务一直留在pending_calls里"""
+        for tool_call_id in tool_call_ids:
+            task = pending_calls.pop(tool_call_id, None)
+            if task is not None:
+                task.cancel()
 
     # 定义节点函数
-    def agent_node(state: AgentState):
+    async def agent_node(state: AgentState):
         """智能体节点--用来处理用户输入
         参数：state--当前的状态，包含消息历史
         返回：新消息的字典
         """
-        response = llm_with_tools.invoke(state["messages"])
+        last_message = state["messages"][-1]
+        # 新问题先走规则路由，命中就直接生成工具调用，不用等大模型决定
+        if isinstance(last_message, HumanMessage) and isinstance(last_message.content, str):
+            tool_calls = [call for call in route_query(last_message.content) if call["name"] in tools_by_name]
+            if tool_calls:
+                return {"messages": [AIMessage(content="", tool_calls=tool_calls,
+                                               id=f"{ROUTER_MESSAGE_PREFIX}{uuid4().hex}")]}
+
+        # 流式生成，不阻塞事件循环；token会通过stream_mode="messages"实时推送给handle_user_query
+        # 一次返回多个工具调用时，第i+1个调用开始出现说明第i个已经解码完成，立刻开始执行，与后续解码重叠
+        response = None
+        started = 0
+        started_ids = []
+        try:
+            async for chunk in get_llm_with_tools().astream([SYSTEM_MESSAGE, *state["messages"]]):
+                response = chunk if response is None else response + chunk
+                completed = len(response.tool_call_chunks) - 1
+                for tool_call_chunk in response.tool_call_chunks[started:completed]:
+                    started_ids.append(start_tool_call(tool_call_chunk))
+                started = max(started, completed)
+            # 最后一个工具调用在生成结束时完成
+            if response is not None:
+                for tool_call_chunk in response.tool_call_chunks[started:]:
+                    started_ids.append(start_tool_call(tool_call_chunk))
+        except BaseException:
+            # 生成中途出错或被取消，已经启动的调用不会再有工具节点来取
+            cancel_tool_calls(started_ids)
+            raise
+
+        # 最终消息里没有的调用（比如被解析成invalid_tool_calls）工具节点不会执行，直接取消
+        valid_ids = {tool_call["id"] for tool_call in response.tool_calls} if response is not None else set()
+        cancel_tool_calls(tool_call_id for tool_call_id in started_ids if tool_call_id not in valid_ids)
         return {"messages": [response]}
 
-    # 创建工具节点，用来执行工具调用
-    tool_node = ToolNode(tools)
+    # 工具节点，执行最后一条AI消息中的工具调用，已经提前启动的直接等待结果，其余的并发执行
+    async def tool_node(state: AgentState):
+        """工具节点--执行工具调用
+        参数：state--当前状态，最后一条消息包含工具调用
+        返回：工具结果消息的字典
+        """
+        tool_calls = state["messages"][-1].tool_calls
+        results = await asyncio.gather(*(
+            pending_calls.pop(tool_call["id"]) if tool_call["id"] in pending_calls else run_tool_call(tool_call)
+            for tool_call in tool_calls
+        ))
+        return {"messages": list(results)}
+
+    # 模板节点，规则路由的简单查询直接用模板生成回答
+    def template_node(state: AgentState):
+        """模板节点--不调用大模型，直接用模板生成回答
+        参数：state--当前状态，最后若干条消息是工具结果
+        返回：回答消息的字典
+        """
+        return {"messages": [AIMessage(content=render_template_answer(state["messages"]))]}
+
+    # 判断工具执行完之后由谁生成回答
+    def should_use_template(state: AgentState):
+        """决定工具执行完后是套用模板还是交给大模型
+        参数：state--当前状态
+        返回：template--可以直接套用模板
+             agent--交给大模型整理回答
+        """
+        if render_template_answer(state["messages"]) is not None:
+            return "template"
+        return "agent"
 
     # 判断是否需要调用工具
     def should_use_tools(state: AgentState):
@@ -89,6 +424,7 @@ def create_stock_agent(tools):
     # 添加节点到图中
     workflow.add_node("agent", agent_node)
     workflow.add_node("tools", tool_node)
+    workflow.add_node("template", template_node)
 
     # 设置边（节点直接的连接关系），开始节点到智能体节点
     workflow.add_edge(START, "agent")
@@ -102,81 +438,206 @@ def create_stock_agent(tools):
             "end": END
         }
     )
-    workflow.add_edge("tools", "agent")
+    workflow.add_conditional_edges(
+        "tools",
+        should_use_template,
+        {
+            "template": "template",
+            "agent": "agent"
+        }
+    )
+    workflow.add_edge("template", END)
 
     # 编译图--创建内存检查点保存器，用于保存对话状态
     memory = InMemorySaver()
     return workflow.compile(checkpointer=memory)
 
 
+# 交互模式下所有查询共用一个会话，配置固定不变
+SESSION_CONFIG = {"configurable": {"thread_id": "user_session"}}
+
+
 # 处理用户查询
 async def handle_user_query(query, agent):
     """处理用户查询并显示结果
     参数：query -- 用户输入的查询文本
          agent -- 编译后的智能体图
     """
-    config = {"configurable": {"thread_id": "user_session"}}
-
     try:
-        #使用astream方法流式处理用户查询，实时看到处理过程，而不是等待全部完成
-        async for event in agent.astream(
+        #使用astream方法流式处理用户查询，stream_mode="messages"逐个token输出AI回复，而不是等整段生成完
+        streaming = False
+        async for message, metadata in agent.astream(
                 {"messages": [{"role": "user", "content": query}]},
-                config
+                SESSION_CONFIG,
+                stream_mode="messages"
         ):
-            #遍历事件中每个节点输出
-            for node_name, node_output in event.items():
-                if "messages" in node_output:
-                    message = node_output["messages"][-1]
-
-                    #如果是智能体节点的输出-显示AI的文本回复-显示工具调用信息
-                    if node_name == "agent":
-                        # 显示AI回复
-                        if hasattr(message, 'content') and message.content:
-                            print(f"AI: {message.content}")
-
-                        # 显示工具调用信息
-                        if hasattr(message, 'tool_calls') and message.tool_calls:
-                            for tool_call in message.tool_calls:
-                                print(f"调用工具: {tool_call['name']}")
-
-                    #如果是工具调用信息
-                    elif node_name == "tools":
-                        print("工具执行完成")
+            node_name = metadata.get("langgraph_node")
+
+            #如果是智能体节点的输出-显示AI的文本回复-显示工具调用信息
+            if node_name == "agent":
+                # 逐个token显示AI回复
+                if message.content:
+                    if not streaming:
+                        print("AI: ", end="", flush=True)
+                        streaming = True
+                    print(message.content, end="", flush=True)
+
+                # 显示工具调用信息，流式块中只有每个调用的第一块带工具名
+                if isinstance(message, AIMessageChunk):
+                    tool_calls = message.tool_call_chunks
+                else:
+                    tool_calls = getattr(message, 'tool_calls', None) or []
+                for tool_call in tool_calls:
+                    if tool_call.get('name'):
+                        if streaming:
+                            print()
+                            streaming = False
+                        print(f"调用工具: {tool_call['name']}")
+
+            #如果是工具调用信息
+            elif node_name == "tools":
+                print("工具执行完成")
+
+            #如果是模板生成的回答
+            elif node_name == "template":
+                print(f"AI: {message.content}")
+
+        if streaming:
+            print()
 
     except Exception as e:
         print(f"处理查询时出错: {e}")
 
 
+# 批量查询 -- 脚本或批量场景下一次提交很多问题，并发处理而不是一个个排队
+class LLMCallDone(AsyncCallbackHandler):
+    """大模型请求结束（成功或失败）时设置事件，用来判断前缀缓存是否已经建立"""
+
+    def __init__(self, event):
+        self.event = event
+
+    async def on_llm_end(self, response, **kwargs):
+        self.event.set()
+
+    async def on_llm_error(self, error, **kwargs):
+        self.event.set()
+
+
+class BatchProcessor:
+    """批量处理用户查询
+    参数：agent--编译后的智能体图
+         max_concurrency--最大并发数，避免触发DeepSeek和Tushare的限流
+    """
+
+    def __init__(self, agent, max_concurrency=10):
+        self.agent = agent
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def process(self, query, callbacks=None):
+        """处理单个查询，返回最终回答
+        参数：callbacks--可选的LangChain回调，会传给工作流中的大模型调用
+        """
+        async with self.semaphore:
+            # 每个问题使用独立的会话，互不干扰
+            config = {"configurable": {"thread_id": f"batch_{uuid4().hex}"}}
+            if callbacks:
+                config["callbacks"] = callbacks
+            result = await self.agent.ainvoke(
+                {"messages": [{"role": "user", "content": query}]},
+                config
+            )
+            return result["messages"][-1].content
+
+    async def run(self, queries):
+        """并发处理所有查询，结果顺序与输入一致，出错的查询返回异常对象
+        第一个查询先发出，等它的第一次大模型请求结束、DeepSeek缓存了所有请求共有的前缀（系统提示词和工具定义）后，
+        其余查询再并发发出，都能命中前缀缓存，降低首token延迟和费用
+        """
+        if not queries:
+            return []
+
+        # 第一个查询走规则路由时不一定调用大模型，等待预热没有意义，直接全部并发
+        if route_query(queries[0]):
+            return await asyncio.gather(
+                *(self.process(query) for query in queries),
+                return_exceptions=True
+            )
+
+        # 只等第一次大模型请求结束就放行，不用等第一个查询的工具调用和最终回答；第一个查询提前结束（比如出错）也放行
+        warmed = asyncio.Event()
+        first = asyncio.create_task(self.process(queries[0], callbacks=[LLMCallDone(warmed)]))
+        waiter = asyncio.create_task(warmed.wait())
+        await asyncio.wait([first, waiter], return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+
+        return await asyncio.gather(
+            first,
+            *(self.process(query) for query in queries[1:]),
+            return_exceptions=True
+        )
+
+
+# 批量处理文件中的查询
+async def run_batch(path, agent):
+    """批量处理查询文件并显示结果
+    参数：path -- 查询文件路径，每行一个问题
+         agent -- 编译后的智能体图
+    """
+    with open(path, encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    results = await BatchProcessor(agent).run(queries)
+    for query, result in zip(queries, results):
+        print(f"\n问题: {query}")
+        if isinstance(result, Exception):
+            print(f"处理查询时出错: {result}")
+        else:
+            print(f"AI: {result}")
+
+
 # 主函数
 async def main():
     """主程序"""
     print("正在启动股票查询系统...")
 
-    # 初始化工具
-    tools = await setup_mcp_tools()
-    if not tools:
-        print("无法启动系统：工具初始化失败")
-        return
+    # 程序退出时自动关闭MCP会话
+    async with AsyncExitStack() as stack:
+        # 初始化工具
+        tools = await setup_mcp_tools(stack)
+        if not tools:
+            print("无法启动系统：工具初始化失败")
+            return
 
-    # 创建智能体
-    agent = create_stock_agent(tools)
-    print("系统启动完成！")
+        # 创建智能体
+        agent = create_stock_agent(tools)
+        print("系统启动完成！")
 
-    # 交互循环 -- 持续接收用户输入
-    while True:
-        try:
-            user_input = input("\n请输入您的查询 (输入 'quit' 退出): ").strip()
+        # 命令行传入查询文件时进入批量模式
+        if len(sys.argv) > 1:
+            await run_batch(sys.argv[1], agent)
+            return
 
-            if user_input.lower() in ['quit', 'exit', 'q']:
-                print("再见！")
-                break
+        # 交互循环 -- 持续接收用户输入
+        while True:
+            try:
+                user_input = input("\n请输入您的查询 (输入 'quit' 退出): ").strip()
 
-            if user_input:
-                await handle_user_query(user_input, agent)
+                if user_input.lower() in ['quit', 'exit', 'q']:
+                    print("再见！")
+                    break
 
-        except Exception as e:
-            print(f"发生错误: {e}")
+                if user_input:
+                    await handle_user_query(user_input, agent)
+
+            except Exception as e:
+                print(f"发生错误: {e}")
 
 #Python程序入口点
 if __name__ == "__main__":
-    asyncio.run(main())
+    # 有uvloop时使用基于libuv的事件循环，流式token和MCP通信等大量小I/O更快；Windows等不支持的平台使用默认事件循环
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -0,0 +1,135 @@
+"""
+规则路由和模板回答的测试
+route_query和render_template_answer都是纯函数，不需要启动MCP服务器，也不会调用大模型
+运行：python -m pytest -q
+"""
+import json
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from stock_agent import ROUTER_MESSAGE_PREFIX, render_template_answer, route_query
+
+# 模拟的工具返回结果
+TOOL_RESULTS = {
+    "get_stock_basic": [
+        {"ts_code": "600519.SH", "name": "贵州茅台", "area": "贵州", "industry": "白酒", "list_date": "20010827"}
+    ],
+    "get_realtime_price": [
+        {"ts_code": "600519.SH", "trade_date": "20240102", "open": 1715.0, "high": 1720.0,
+         "low": 1685.0, "close": 1690.0, "pct_chg": -1.46}
+    ],
+    "get_stock_price": [
+        {"trade_date": "20240102", "open": 1715.0, "high": 1720.0, "low": 1685.0, "close": 1690.0, "pct_chg": -1.46},
+        {"trade_date": "20231229", "open": 1705.0, "high": 1728.0, "low": 1701.0, "close": 1715.0, "pct_chg": 0.6},
+    ],
+    "get_financial_indicator": [{"ts_code": "600519.SH", "roe": 34.2}],
+}
+
+
+def routed(question):
+    """把route_query的结果简化成(工具名, 参数)列表"""
+    return [(tool_call["name"], tool_call["args"]) for tool_call in route_query(question)]
+
+
+def answer(question, results=None, message_id=None, as_blocks=False):
+    """模拟一轮规则路由 + 工具执行，返回模板回答
+    as_blocks=True时按新版langchain-mcp-adapters的格式，把工具结果包装成内容块列表
+    """
+    tool_calls = route_query(question)
+    assert tool_calls, "规则路由应该识别这个问题"
+    results = results or {}
+    messages = [
+        HumanMessage(content=question),
+        AIMessage(content="", tool_calls=tool_calls, id=message_id or f"{ROUTER_MESSAGE_PREFIX}test"),
+    ]
+    for tool_call in tool_calls:
+        content = results.get(tool_call["name"], json.dumps(TOOL_RESULTS[tool_call["name"]], ensure_ascii=False))
+        if as_blocks:
+            content = [{"type": "text", "text": content}]
+        messages.append(ToolMessage(content=content, name=tool_call["name"], tool_call_id=tool_call["id"]))
+    return render_template_answer(messages)
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("贵州茅台的基本信息", [("get_stock_basic", {"stock_code": "600519.SH"})]),
+    ("查询600519最新股价", [("get_realtime_price", {"stock_code": "600519.SH"})]),
+    ("茅台现在的行情", [("get_realtime_price", {"stock_code": "600519.SH"})]),
+    ("茅台最新财务指标", [("get_financial_indicator", {"stock_code": "600519.SH"})]),
+    ("000002.sz 财务指标和K线", [
+        ("get_financial_indicator", {"stock_code": "000002.SZ"}),
+        ("get_stock_price", {"stock_code": "000002.SZ"}),
+    ]),
+    ("430047.BJ 行情", [("get_stock_price", {"stock_code": "430047.BJ"})]),
+    ("比较茅台和招行的股价走势", [
+        ("get_stock_price", {"stock_code": "600519.SH"}),
+        ("get_stock_price", {"stock_code": "600036.SH"}),
+    ]),
+])
+def test_route_query(question, expected):
+    assert routed(question) == expected
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("茅台最近10天的股价", [("get_stock_price", {"stock_code": "600519.SH", "limit": 10})]),
+    ("茅台最新20个交易日行情", [("get_stock_price", {"stock_code": "600519.SH", "limit": 20})]),
+    ("茅台2022年的财务指标", [("get_financial_indicator", {"stock_code": "600519.SH", "period": "20221231"})]),
+])
+def test_route_query_passes_parameters(question, expected):
+    assert routed(question) == expected
+
+
+@pytest.mark.parametrize("question", [
+    "今天天气怎么样",
+    "我有100000元，买茅台还是招行",
+    "我有100000元，茅台和招行的股价",
+    "600519元的股价",
+    "茅台今天的股价",
+    "茅台2022年三季度财务指标",
+    "茅台2022年的股价",
+    "茅台10天的业绩",
+    "茅台最近10天和20天的股价",
+    "茅台最近0天股价",
+    "茅台最近500天股价",
+    "茅台最近1000天股价",
+])
+def test_route_query_falls_back_to_llm(question):
+    assert route_query(question) == []
+
+
+SIMPLE_LOOKUP_ANSWERS = [
+    ("贵州茅台的基本信息", "贵州茅台（600519.SH）位于贵州，属于白酒行业，20010827上市。"),
+    ("茅台的最新股价？", "600519.SH最新交易日20240102：开盘1715.0，最高1720.0，最低1685.0，收盘1690.0，涨跌幅-1.46%。"),
+    ("600519.SH行情", "600519.SH 20240102：开盘1715.0，最高1720.0，最低1685.0，收盘1690.0，涨跌幅-1.46%。\n"
+                      "600519.SH 20231229：开盘1705.0，最高1728.0，最低1701.0，收盘1715.0，涨跌幅0.6%。"),
+]
+
+
+@pytest.mark.parametrize("question, expected", SIMPLE_LOOKUP_ANSWERS)
+def test_render_template_answer_for_simple_lookup(question, expected):
+    assert answer(question) == expected
+
+
+@pytest.mark.parametrize("question, expected", SIMPLE_LOOKUP_ANSWERS)
+def test_render_template_answer_reads_content_blocks(question, expected):
+    assert answer(question, as_blocks=True) == expected
+
+
+@pytest.mark.parametrize("question", [
+    "茅台现在值得买吗",
+    "茅台股价为什么跌了",
+    "比较茅台和招行的股价走势",
+    "茅台最近10天的股价",
+    "茅台的财务指标",
+])
+def test_render_template_answer_leaves_real_questions_to_llm(question):
+    assert answer(question) is None
+
+
+def test_render_template_answer_ignores_llm_tool_calls():
+    assert answer("贵州茅台的基本信息", message_id="run-1") is None
+
+
+@pytest.mark.parametrize("content", ['{"error": "token无效"}', "[]", '[{"ts_code": "600519.SH"}]', "错误；超时"])
+def test_render_template_answer_falls_back_on_bad_results(content):
+    assert answer("贵州茅台的基本信息", {"get_stock_basic": content}) is None